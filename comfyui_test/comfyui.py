@@ -5,16 +5,94 @@ import os
 import json
 import time
 import base64
+import binascii
+import functools
+import gzip
+import hashlib
 import argparse
 import io
 import ast
 import re
+import mmap
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
 from pathlib import Path
-from json import JSONDecodeError
 
+import msgspec
 import requests
 from PIL import Image
 
+try:
+    import orjson  # 可选加速：Rust 序列化器，嵌入大 base64 串时明显快于 stdlib
+except ImportError:
+    orjson = None
+
+try:
+    import pybase64  # 可选加速：SSSE3/AVX2 向量化 base64，多 MB 图片收益明显
+except ImportError:
+    pybase64 = None
+
+try:
+    import httpx  # 可选：HTTP/2 复用单条 TLS 连接，响应头解析也更省
+except ImportError:
+    httpx = None
+
+# workflow JSON 超过该大小时用 mmap 读取，避免 read_bytes 的整文件拷贝
+_MMAP_JSON_THRESHOLD = 10 * 1024 * 1024
+
+# 顶层非节点字段：旧版 worker 会把它们误判为节点
+_BAD_TOP_KEYS = frozenset({"config", "definitions"})
+
+# 请求体超过该大小时 gzip 压缩上传（嵌入 base64 输入图的 payload 很容易超）
+_GZIP_BODY_THRESHOLD = 64 * 1024
+
+
+def _dumps(obj: dict) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+class OutputImg(msgspec.Struct):
+    filename: str | None = None
+    type: str = "base64"
+    data: str = ""
+
+
+class Output(msgspec.Struct):
+    images: list[OutputImg] = []
+    message: str | None = None
+
+
+class Result(msgspec.Struct):
+    """
+    RunPod 返回里我们真正用到的字段。msgspec 按 schema 解码，
+    跳过响应里其余的大块内容（不为用不到的字段建 dict/list）。
+    """
+
+    status: str = ""
+    error: str | None = None
+    output: Output | None = None
+    id: str = ""
+    raw: bytes = b""  # 原始响应字节（解码后补挂），result.json 直接用它
+
+
+def _decode_result(raw: bytes) -> Result:
+    res = msgspec.json.decode(raw, type=Result)
+    res.raw = raw
+    return res
+
+
+# Validation-error line pattern (compiled once; parse_validation_issues may run
+# several times on the retry path). One alternation covers both the `errors`
+# and `class_type` lines so the whole blob is scanned in a single finditer pass.
+# Bytes-level with the literal UTF-8 bullet (\xe2\x80\xa2) as prefix: no Unicode
+# \s class tables, and the engine's literal-prefix scan skips non-matching
+# regions quickly.
+_VALIDATION_RE = re.compile(
+    rb"^[ \t]*\xe2\x80\xa2 Node (?P<id>[^ ]+) \((?P<kind>errors|class_type)\): (?P<rest>.+)$",
+    re.M,
+)
 
 
 def load_payload(payload_path: Path) -> dict:
@@ -26,11 +104,22 @@ def load_payload(payload_path: Path) -> dict:
     if not payload_path.exists():
         raise FileNotFoundError(f"workflow file not found: {payload_path}")
 
-    raw_text = payload_path.read_text(encoding="utf-8")
     try:
-        data = json.loads(raw_text)
-    except JSONDecodeError as exc:
-        first_line = raw_text.splitlines()[0].strip() if raw_text else ""
+        if orjson is not None:
+            # orjson 直接吃 bytes，省掉 read_text 的整文件 UTF-8 解码；
+            # 超大 workflow 走 mmap，避免再复制一份到用户态 buffer
+            if payload_path.stat().st_size > _MMAP_JSON_THRESHOLD:
+                with open(payload_path, "rb") as f, mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ
+                ) as mm:
+                    data = orjson.loads(memoryview(mm))
+            else:
+                data = orjson.loads(payload_path.read_bytes())
+        else:
+            data = json.loads(payload_path.read_bytes())
+    except ValueError as exc:  # orjson.JSONDecodeError / json.JSONDecodeError
+        with open(payload_path, "rb") as f:
+            first_line = f.readline().decode("utf-8", "replace").strip()
         hint = ""
         if first_line.startswith("#!") or first_line.startswith("import "):
             hint = (
@@ -80,28 +169,27 @@ def parse_validation_issues(error_text: str) -> list[dict]:
     if not isinstance(error_text, str) or "Workflow validation failed" not in error_text:
         return []
 
+    # Cheap C-level substring test before touching the regex engine; blobs that
+    # carry the header but no per-node lines bail out here.
+    if "• Node " not in error_text:
+        return []
+
     node_errors: dict[str, list[dict]] = {}
     node_class: dict[str, str] = {}
 
-    errors_pattern = re.compile(r"^\s*• Node ([^ ]+) \(errors\): (.+)$")
-    class_pattern = re.compile(r"^\s*• Node ([^ ]+) \(class_type\): (.+)$")
-
-    for line in error_text.splitlines():
-        m_err = errors_pattern.match(line)
-        if m_err:
-            node_id = m_err.group(1)
-            raw_errors = m_err.group(2).strip()
+    # 一次性编码为 bytes 后扫描，匹配行内的内容都是 ASCII，逐组按需解码
+    for m in _VALIDATION_RE.finditer(error_text.encode("utf-8", "ignore")):
+        node_id = m.group("id").decode("utf-8", "replace")
+        rest = m.group("rest").decode("utf-8", "replace").strip()
+        if m.group("kind") == b"errors":
             try:
-                parsed = ast.literal_eval(raw_errors)
+                parsed = ast.literal_eval(rest)
             except Exception:
                 continue
             if isinstance(parsed, list):
                 node_errors[node_id] = [e for e in parsed if isinstance(e, dict)]
-            continue
-
-        m_cls = class_pattern.match(line)
-        if m_cls:
-            node_class[m_cls.group(1)] = m_cls.group(2).strip()
+        else:
+            node_class[node_id] = rest
 
     issues: list[dict] = []
     for node_id, errors in node_errors.items():
@@ -192,7 +280,7 @@ def apply_validation_fallbacks(payload: dict, issues: list[dict]) -> tuple[list[
     return patched, missing
 
 
-def run_job(client: "RunPodComfyClient", payload: dict, mode: str, wait_ms: int, max_wait_s: int) -> dict:
+def run_job(client: "RunPodComfyClient", payload: dict, mode: str, wait_ms: int, max_wait_s: int) -> Result:
     if mode == "runsync":
         return client.run_sync(payload, wait_ms=wait_ms)
 
@@ -202,6 +290,59 @@ def run_job(client: "RunPodComfyClient", payload: dict, mode: str, wait_ms: int,
     return client.poll_until_done(job_id, max_wait_s=max_wait_s)
 
 
+def _is_positive_title(title) -> bool:
+    # 常见写法（positive/Positive）直接命中，不分配小写副本；
+    # 其它大小写才退回 casefold
+    if not isinstance(title, str) or not title:
+        return False
+    if "positive" in title or "Positive" in title:
+        return True
+    return "positive" in title.casefold()
+
+
+def submit_with_recovery(client: "RunPodComfyClient", payload: dict, args, max_retries: int = 2) -> Result:
+    """
+    提交任务，validation 失败时自动回退并有限次重试（复用同一客户端连接）。
+    每轮重试前比对 payload 的 blake2b 指纹：回退没改动 payload 就直接放弃，
+    避免把同一个 workflow 原样再提交一遍。
+    """
+    result = run_job(client, payload, args.mode, args.wait_ms, args.max_wait_s)
+    missing: list[str] = []
+
+    for _ in range(max_retries):
+        if (result.status or "").upper() == "COMPLETED":
+            break
+
+        issues = parse_validation_issues(result.error or "")
+        if not issues:
+            break
+
+        signature = hashlib.blake2b(_dumps(payload)).digest()
+        patched, missing = apply_validation_fallbacks(payload, issues)
+        if hashlib.blake2b(_dumps(payload)).digest() == signature:
+            # 没有可自动修复的点，重试只会复现同样的失败
+            break
+
+        print("[INFO] auto-fixed workflow inputs:")
+        for msg in patched:
+            print(f"  - {msg}")
+        print("[INFO] retrying with patched workflow...")
+        result = run_job(client, payload, args.mode, args.wait_ms, args.max_wait_s)
+
+    if missing and (result.status or "").upper() != "COMPLETED":
+        print("[ERROR] endpoint model inventory is incomplete:")
+        for msg in missing:
+            print(f"  - {msg}")
+        print(
+            "[ERROR] fix options:\n"
+            "  1) upload/mount the required model files to the endpoint volume and restart worker\n"
+            "  2) edit workflow to use model names that actually exist on this endpoint\n"
+            "  3) switch to an endpoint with preloaded models"
+        )
+
+    return result
+
+
 def patch_positive_prompt(payload: dict, prompt: str) -> int:
     """
     尝试把 workflow 里 “Positive Prompt” 的 text 替换掉。
@@ -214,21 +355,8 @@ def patch_positive_prompt(payload: dict, prompt: str) -> int:
 
     changed = 0
 
-    # API prompt format: {"12": {"class_type": "...", "inputs": {...}}}
-    for _, node in workflow.items():
-        if not isinstance(node, dict):
-            continue
-        if node.get("class_type") != "CLIPTextEncode":
-            continue
-        meta = node.get("_meta") or {}
-        title = (meta.get("title") or "").lower()
-        if "positive" in title:
-            inputs = node.setdefault("inputs", {})
-            if "text" in inputs:
-                inputs["text"] = prompt
-                changed += 1
-
     # Frontend workflow format: {"nodes":[...], "links":[...], ...}
+    # 两种格式互斥，判定一次后直接走对应分支
     nodes = workflow.get("nodes")
     if isinstance(nodes, list):
         for node in nodes:
@@ -236,13 +364,27 @@ def patch_positive_prompt(payload: dict, prompt: str) -> int:
                 continue
             if node.get("type") != "CLIPTextEncode":
                 continue
-            title = (node.get("title") or "").lower()
-            if "positive" not in title:
+            if not _is_positive_title(node.get("title")):
                 continue
             widgets = node.get("widgets_values")
             if isinstance(widgets, list) and widgets:
                 widgets[0] = prompt
                 changed += 1
+        return changed
+
+    # API prompt format: {"12": {"class_type": "...", "inputs": {...}}}
+    for node in workflow.values():
+        if not isinstance(node, dict):
+            continue
+        if node.get("class_type") != "CLIPTextEncode":
+            continue
+        meta = node.get("_meta") or {}
+        if not _is_positive_title(meta.get("title")):
+            continue
+        inputs = node.setdefault("inputs", {})
+        if "text" in inputs:
+            inputs["text"] = prompt
+            changed += 1
 
     return changed
 
@@ -256,7 +398,64 @@ def sanitize_workflow(payload: dict) -> list[str]:
     if not isinstance(workflow, dict):
         return []
 
-    removed: list[str] = []
+    # Frontend workflow JSON shape (cannot be sent directly to /prompt style workers)
+    if isinstance(workflow.get("nodes"), list) and isinstance(workflow.get("links"), list):
+        raise ValueError(
+            "Detected frontend workflow JSON (contains nodes/links). "
+            "This worker expects API prompt JSON. "
+            "Please export `workflow_api.json` (or Save as API format) from ComfyUI and use that file."
+        )
+
+    # API prompt shape: remove non-node entries that lack class_type.
+    # 单次 items() 扫描选出待删 key，再批量删除（不在迭代中改 dict）
+    removed = [
+        k
+        for k, v in workflow.items()
+        if not (isinstance(v, dict) and "class_type" in v)
+        and (k.startswith("#") or k in _BAD_TOP_KEYS)
+    ]
+    for k in removed:
+        workflow.pop(k, None)
+
+    if not workflow:
+        raise ValueError(
+            "Workflow has no executable nodes after sanitization. "
+            "Please provide an API prompt JSON export from ComfyUI."
+        )
+
+    return removed
+
+
+# 文件魔数 -> MIME；按真实容器判型，扩展名写错也不会发出错误的 MIME
+_MIME_MAGIC = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"RIFF", "image/webp"),
+)
+
+
+@functools.lru_cache(maxsize=8)
+def _encode_image_cached(path_str: str, mtime_ns: int, size: int) -> str:
+    # key 带上 mtime/size：文件被改写后缓存自动失效
+    image_path = Path(path_str)
+    raw = image_path.read_bytes()
+    mime = next((m for magic, m in _MIME_MAGIC if raw.startswith(magic)), None)
+    if mime is None:
+        # 魔数不认识时退回原来的扩展名推断
+        mime = "image/jpeg" if image_path.suffix.lower() in (".jpg", ".jpeg") else "image/png"
+    encoded = pybase64.b64encode(raw) if pybase64 is not None else base64.b64encode(raw)
+    return f"data:{mime};base64,{encoded.decode('ascii')}"
+
+
+def preprocess_workflow(payload: dict, prompt: str | None) -> tuple[list[str], int]:
+    """
+    单次遍历完成 sanitize_workflow + patch_positive_prompt 的工作：
+    清理非节点字段的同时替换 Positive CLIPTextEncode 的 text。
+    返回 (removed_keys, patched_count)。prompt 为空时只做清理。
+    """
+    workflow = payload.get("input", {}).get("workflow")
+    if not isinstance(workflow, dict):
+        return [], 0
 
     # Frontend workflow JSON shape (cannot be sent directly to /prompt style workers)
     if isinstance(workflow.get("nodes"), list) and isinstance(workflow.get("links"), list):
@@ -266,14 +465,25 @@ def sanitize_workflow(payload: dict) -> list[str]:
             "Please export `workflow_api.json` (or Save as API format) from ComfyUI and use that file."
         )
 
-    # API prompt shape: remove non-node entries that lack class_type
-    for key in list(workflow.keys()):
-        value = workflow.get(key)
-        if isinstance(value, dict) and "class_type" in value:
+    removed: list[str] = []
+    patched = 0
+
+    for key, node in workflow.items():
+        if not (isinstance(node, dict) and "class_type" in node):
+            if key.startswith("#") or key in _BAD_TOP_KEYS:
+                removed.append(key)
             continue
-        if key.startswith("#") or key in {"config", "definitions"}:
-            removed.append(key)
-            workflow.pop(key, None)
+
+        if prompt and node.get("class_type") == "CLIPTextEncode":
+            meta = node.get("_meta") or {}
+            if _is_positive_title(meta.get("title")):
+                inputs = node.setdefault("inputs", {})
+                if "text" in inputs:
+                    inputs["text"] = prompt
+                    patched += 1
+
+    for k in removed:
+        workflow.pop(k, None)
 
     if not workflow:
         raise ValueError(
@@ -281,122 +491,191 @@ def sanitize_workflow(payload: dict) -> list[str]:
             "Please provide an API prompt JSON export from ComfyUI."
         )
 
-    return removed
+    return removed, patched
 
 
 def encode_image_data_uri(image_path: Path) -> str:
     """
-    把本地图片转为 data URI base64（worker-comfyui 支持带不带 data URI 前缀）
+    把本地图片转为 data URI base64（worker-comfyui 支持带不带 data URI 前缀）。
+    同一文件重复编码（批量/重试路径）时直接命中缓存。
     """
-    ext = image_path.suffix.lower()
-    if ext in [".jpg", ".jpeg"]:
-        mime = "image/jpeg"
-    else:
-        mime = "image/png"
-    b64 = base64.b64encode(image_path.read_bytes()).decode("utf-8")
-    return f"data:{mime};base64,{b64}"
+    st = image_path.stat()
+    return _encode_image_cached(str(image_path), st.st_mtime_ns, st.st_size)
 
 
 def attach_input_image(payload: dict, image_path: Path, name: str) -> None:
     """
     往 payload.input.images 里塞一张输入图。
     注意：你的 workflow 里需要用 LoadImage 等节点引用同名文件（name）。
+    同名条目已存在时（例如重试复用同一 payload）不重复附加。
     """
     payload.setdefault("input", {})
-    payload["input"].setdefault("images", [])
-    payload["input"]["images"].append(
-        {"name": name, "image": encode_image_data_uri(image_path)}
-    )
+    images = payload["input"].setdefault("images", [])
+    if any(isinstance(img, dict) and img.get("name") == name for img in images):
+        return
+    images.append({"name": name, "image": encode_image_data_uri(image_path)})
 
 
-def extract_images_from_result(result: dict) -> list[dict]:
+def extract_images_from_result(result: Result) -> list[OutputImg]:
     """
-    5.0.0+（含 5.5.1）标准输出：output.images[]，每个元素包含 type=base64|s3_url 与 data。 
+    5.0.0+（含 5.5.1）标准输出：output.images[]，每个元素包含 type=base64|s3_url 与 data。
     兼容旧输出 output.message（兜底）。
     """
-    output = result.get("output") or {}
+    output = result.output
+    if output is None:
+        return []
 
-    images = output.get("images")
-    if isinstance(images, list) and images:
-        return images
+    if output.images:
+        return output.images
 
     # legacy fallback
-    msg = output.get("message")
+    msg = output.message
     if isinstance(msg, str) and msg.strip():
-        return [{"filename": "output.png", "type": "base64", "data": msg}]
+        return [OutputImg(filename="output.png", type="base64", data=msg)]
 
     return []
 
 
-def save_images(images: list[dict], outdir: Path) -> None:
-    outdir.mkdir(parents=True, exist_ok=True)
+# Container magic bytes -> extensions that can be written without a PIL
+# decode/re-encode round trip.
+_PASSTHROUGH_FORMATS = [
+    (b"\x89PNG\r\n\x1a\n", {".png"}),
+    (b"\xff\xd8\xff", {".jpg", ".jpeg"}),
+]
 
-    for i, item in enumerate(images, start=1):
-        filename = item.get("filename") or f"image_{i:02d}.png"
-        typ = (item.get("type") or "base64").lower()
-        data = item.get("data") or ""
 
-        if typ == "s3_url":
-            print(f"[S3] {filename} -> {data}")
-            continue
+def _write_raw(outpath: Path, raw: bytes) -> None:
+    # 直接 os.open/os.write：跳过 pathlib/io 的 BufferedWriter 封装，
+    # 整块字节一次 write(2) 落盘
+    fd = os.open(outpath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, raw)
+    finally:
+        os.close(fd)
+
 
-        # base64
-        if "," in data:
-            data = data.split(",", 1)[1]  # strip data URI prefix
+def _save_one(i: int, item: OutputImg, outdir: Path) -> None:
+    filename = item.filename or f"image_{i:02d}.png"
+    typ = (item.type or "base64").lower()
+    data = item.data or ""
 
-        raw = base64.b64decode(data)
+    if typ == "s3_url":
+        print(f"[S3] {filename} -> {data}")
+        return
+
+    # base64 — strip an optional data URI prefix with find+slice (no
+    # two-element list allocation) and decode on binascii's C fast path.
+    comma = data.find(",")
+    if comma != -1:
+        data = data[comma + 1:]
+
+    if pybase64 is not None:
+        raw = pybase64.b64decode(data, validate=False)
+    else:
+        raw = binascii.a2b_base64(data.encode("ascii"), strict_mode=False)
+    outpath = outdir / filename
+    suffix = outpath.suffix.lower()
+
+    # The decoded bytes are already a finished PNG/JPEG container; when the
+    # target extension matches, dump them as-is instead of paying for a PIL
+    # decode + re-encode (and a second image-sized buffer).
+    if any(raw.startswith(magic) and suffix in exts for magic, exts in _PASSTHROUGH_FORMATS):
+        _write_raw(outpath, raw)
+    else:
         img = Image.open(io.BytesIO(raw))
-        outpath = outdir / filename
         img.save(outpath)
-        print(f"[OK] saved -> {outpath.resolve()}")
+    print(f"[OK] saved -> {outpath.resolve()}")
+
+
+def save_images(images: list[OutputImg], outdir: Path) -> None:
+    """
+    把输出图片写入 outdir。约定：outdir 已由调用方创建
+    （main 在写 result.json 前已经 mkdir），这里不再重复 stat/mkdir。
+    多图时用线程池并行：base64 解码（binascii 释放 GIL）与磁盘写入互相重叠。
+    """
+    if not images:
+        return
+
+    if len(images) == 1:
+        _save_one(1, images[0], outdir)
+        return
+
+    with ThreadPoolExecutor(max_workers=min(8, len(images))) as ex:
+        # list() 消费迭代器，让 worker 里的异常在这里抛出
+        list(ex.map(_save_one, range(1, len(images) + 1), images, repeat(outdir)))
 
 
 class RunPodComfyClient:
     def __init__(self, api_key: str, endpoint_id: str):
         self.base_url = f"https://api.runpod.ai/v2/{endpoint_id}"
-        self.s = requests.Session()
-        self.s.headers.update(
-            {
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json",
-            }
-        )
+        headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+        }
+        self._use_httpx = httpx is not None
+        if self._use_httpx:
+            try:
+                self.s = httpx.Client(http2=True, headers=headers, timeout=30.0)
+            except ImportError:
+                # httpx 装了但缺 h2 extra：退回 HTTP/1.1，连接复用仍然有效
+                self.s = httpx.Client(headers=headers, timeout=30.0)
+        else:
+            self.s = requests.Session()
+            self.s.headers.update(headers)
+
+    def _post_json(self, url: str, payload: dict, timeout: float):
+        # 序列化一次；大 payload（内嵌 base64 输入图）gzip 后上传，省上行带宽
+        body = _dumps(payload)
+        headers = None
+        if len(body) > _GZIP_BODY_THRESHOLD:
+            body = gzip.compress(body)
+            headers = {"Content-Encoding": "gzip"}
+        if self._use_httpx:
+            r = self.s.post(url, content=body, headers=headers, timeout=timeout)
+        else:
+            r = self.s.post(url, data=body, headers=headers, timeout=timeout)
+        r.raise_for_status()
+        return r
 
-    def run_sync(self, payload: dict, wait_ms: int = 120000) -> dict:
+    def run_sync(self, payload: dict, wait_ms: int = 120000) -> Result:
         # /runsync 支持 ?wait=毫秒 控制最长等待时间（不是结果保留时间）
         url = f"{self.base_url}/runsync?wait={int(wait_ms)}"
-        r = self.s.post(url, json=payload, timeout=max(30, wait_ms / 1000 + 10))
-        r.raise_for_status()
-        return r.json()
+        r = self._post_json(url, payload, timeout=max(30, wait_ms / 1000 + 10))
+        return _decode_result(r.content)
 
     def run_async(self, payload: dict) -> dict:
         url = f"{self.base_url}/run"
-        r = self.s.post(url, json=payload, timeout=30)
-        r.raise_for_status()
+        r = self._post_json(url, payload, timeout=30)
         return r.json()
 
-    def status(self, job_id: str) -> dict:
+    def status(self, job_id: str, wait_ms: int = 0) -> Result:
+        # /status 同样支持 ?wait=毫秒 长轮询：服务端挂起连接直到状态变化
         url = f"{self.base_url}/status/{job_id}"
-        r = self.s.get(url, timeout=30)
+        if wait_ms > 0:
+            url += f"?wait={int(wait_ms)}"
+        r = self.s.get(url, timeout=max(30, wait_ms / 1000 + 10))
         r.raise_for_status()
-        return r.json()
+        return _decode_result(r.content)
 
-    def poll_until_done(self, job_id: str, max_wait_s: int = 600) -> dict:
+    def poll_until_done(self, job_id: str, max_wait_s: int = 600) -> Result:
         start = time.time()
-        sleep_s = 2.0
+        st = ""
 
         while True:
-            res = self.status(job_id)
-            st = (res.get("status") or "").upper()
+            remaining_s = max_wait_s - (time.time() - start)
+            if remaining_s <= 0:
+                raise TimeoutError(f"Job not finished in {max_wait_s}s, last status={st}")
+
+            t0 = time.time()
+            res = self.status(job_id, wait_ms=min(30000, max(1000, int(remaining_s * 1000))))
+            st = (res.status or "").upper()
 
             if st in {"COMPLETED", "FAILED", "CANCELLED", "TIMED_OUT"}:
                 return res
 
-            if time.time() - start > max_wait_s:
-                raise TimeoutError(f"Job not finished in {max_wait_s}s, last status={st}")
-
-            time.sleep(sleep_s)
-            sleep_s = min(sleep_s * 1.2, 10.0)  # 温和退避
+            # 旧版端点会忽略 wait 立即返回；兜底小睡避免忙等
+            if time.time() - t0 < 1.0:
+                time.sleep(1.0)
 
 
 def main():
@@ -421,7 +700,8 @@ def main():
     workflow_path = resolve_workflow_path(args.workflow)
     try:
         payload = load_payload(workflow_path)
-        removed_keys = sanitize_workflow(payload)
+        # 清理 + 替换 prompt 融合为一次节点遍历
+        removed_keys, changed = preprocess_workflow(payload, args.prompt)
     except (FileNotFoundError, ValueError) as exc:
         raise SystemExit(str(exc)) from exc
 
@@ -429,7 +709,6 @@ def main():
         print(f"[INFO] sanitized workflow keys: {', '.join(removed_keys)}")
 
     if args.prompt:
-        changed = patch_positive_prompt(payload, args.prompt)
         print(f"[INFO] patched positive prompt nodes: {changed}")
 
     if args.input_image:
@@ -438,41 +717,25 @@ def main():
 
     client = RunPodComfyClient(api_key, endpoint_id)
 
-    result = run_job(client, payload, args.mode, args.wait_ms, args.max_wait_s)
-
-    # 自动修复一次 value_not_in_list（若候选非空），并重试一次
-    status = (result.get("status") or "").upper()
-    if status != "COMPLETED":
-        issues = parse_validation_issues(result.get("error", ""))
-        if issues:
-            patched, missing = apply_validation_fallbacks(payload, issues)
-
-            if patched:
-                print("[INFO] auto-fixed workflow inputs:")
-                for msg in patched:
-                    print(f"  - {msg}")
-                print("[INFO] retrying once with patched workflow...")
-                result = run_job(client, payload, args.mode, args.wait_ms, args.max_wait_s)
-                status = (result.get("status") or "").upper()
-
-            if missing and status != "COMPLETED":
-                print("[ERROR] endpoint model inventory is incomplete:")
-                for msg in missing:
-                    print(f"  - {msg}")
-                print(
-                    "[ERROR] fix options:\n"
-                    "  1) upload/mount the required model files to the endpoint volume and restart worker\n"
-                    "  2) edit workflow to use model names that actually exist on this endpoint\n"
-                    "  3) switch to an endpoint with preloaded models"
-                )
+    # 自动回退可修复的 value_not_in_list，并做有限次重试
+    result = submit_with_recovery(client, payload, args)
 
     # 保存完整返回，便于排错
     outdir = Path(args.outdir)
     outdir.mkdir(parents=True, exist_ok=True)
-    (outdir / "result.json").write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+    result_path = outdir / "result.json"
+    raw = result.raw
+    # 响应本身就是合法 JSON：小响应美化后落盘便于阅读；
+    # 大响应（内嵌 base64 图片）原样写出，省掉 bytes->dict->bytes 两次全量遍历
+    if raw and len(raw) < 1_000_000:
+        if orjson is not None:
+            raw = orjson.dumps(orjson.loads(raw), option=orjson.OPT_INDENT_2)
+        else:
+            raw = json.dumps(json.loads(raw), ensure_ascii=False, indent=2).encode("utf-8")
+    result_path.write_bytes(raw)
 
-    if (result.get("status") or "").upper() != "COMPLETED":
-        raise SystemExit(f"Job finished with status={result.get('status')}, see {outdir/'result.json'}")
+    if (result.status or "").upper() != "COMPLETED":
+        raise SystemExit(f"Job finished with status={result.status}, see {outdir/'result.json'}")
 
     images = extract_images_from_result(result)
     if not images: